@@ -2,15 +2,15 @@ import json
 import os.path
 import re
 from datetime import datetime
-from distutils.dir_util import copy_tree as cp
 from enum import Enum
-from os import mkdir
+from os import makedirs
 from os.path import sep
 from pathlib import Path
 from pprint import pformat
+from shutil import copytree
 
 import requests as requests
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from requests.structures import CaseInsensitiveDict
 from z3c.rml import rml2pdf
 
@@ -19,8 +19,44 @@ from modules.server.webserver_type import WebserverType
 from modules.stix.stix import Stix
 from utils.globals import version
 from utils.logger import Logger
-from utils.prune import pruner
-from utils.validation import Validator, rec_search_key
+from utils.prune import prune_and_split
+from utils.validation import Validator
+
+RESULTS_PATH = Path("results")
+ASSETS_PATH = Path(f"configs{sep}out_template{sep}assets")
+RESULTS_ASSETS_PATH = RESULTS_PATH / "assets"
+# written once the assets have been fully copied, an interrupted copy is completed on the next run
+ASSETS_SENTINEL = RESULTS_ASSETS_PATH / ".copied"
+
+
+def _format_host(hostname: str, host_results: dict) -> dict:
+    """
+    Formats the results of a single host.
+
+    :param hostname: Hostname analyzed.
+    :type hostname: str
+    :param host_results: Dictionary containing the results of the host.
+    :type host_results: dict
+    :return: Dictionary containing the formatted results of the host.
+    :rtype: dict
+    """
+    # the results are good, we need to remove the "Entry" key but preserve the rest with the CaseInsensitiveDict
+    host_out = {}
+    if "errors" in host_results:
+        host_out["errors"] = host_results["errors"][hostname]
+    for module, module_results in host_results.items():
+        raw_results = {}
+        if "raw" in module_results:
+            raw_results = module_results["raw"]
+        if "Entry" in module_results:
+            host_out[module] = CaseInsensitiveDict(
+                module_results["Entry"]
+            )
+            if raw_results:
+                host_out[module]["raw"] = json.dumps(
+                    raw_results, indent=2, default=str, ensure_ascii=False
+                )
+    return host_out
 
 
 class Report:
@@ -37,6 +73,9 @@ class Report:
         HOSTS = 0
         MODULES = 1
 
+    # shared by all the instances, so that each template is compiled at most once per process
+    _env = None
+
     def __init__(self):
         self.__input_dict = {}
         self.__path = ""
@@ -99,28 +138,34 @@ class Report:
         :rtype: dict
         """
         out = {}
+        if modules:
+            # the errors do not depend on the module, there is no need to look for them in the inner loop
+            for host_results in results.values():
+                if "errors" in host_results:
+                    out["errors"] = host_results["errors"]
         for module in modules:
+            self.__logging.debug(f"Generating report for {module}")
             vuln_hosts = []
             raw_results = {}
-            if module not in out:
-                out[module] = {}
-            for hostname in results:
-                if "errors" in results[hostname]:
-                    out["errors"] = results[hostname]["errors"]
-                self.__logging.debug(f"Generating report for {hostname}")
-                if module in results[hostname]:
-                    if "raw" in results[hostname][module]:
-                        raw_results[hostname] = results[hostname][module]["raw"].copy()
-                    if "Entry" in results[hostname][module]:
-                        out[module] = CaseInsensitiveDict(
-                            results[hostname][module]["Entry"]
-                        )
-                    if hostname not in vuln_hosts:
-                        vuln_hosts.append(hostname)
+            entry = None
+            out.setdefault(module, {})
+            for hostname, host_results in results.items():
+                if module in host_results:
+                    module_results = host_results[module]
+                    if "raw" in module_results:
+                        raw_results[hostname] = module_results["raw"]
+                    if "Entry" in module_results:
+                        entry = module_results["Entry"]
+                    # each hostname is visited once per module, no need to check for duplicates
+                    vuln_hosts.append(hostname)
+            # the templates access the entry with mixed casing, so it has to stay case insensitive,
+            # but it is enough to wrap the last entry found instead of one per host
+            if entry is not None:
+                out[module] = CaseInsensitiveDict(entry)
             if raw_results:
-                out[module]["raw"] = pformat(raw_results.copy(), indent=2)
+                out[module]["raw"] = json.dumps(raw_results, indent=2, default=str, ensure_ascii=False)
             if vuln_hosts:
-                out[module]["hosts"] = vuln_hosts.copy()
+                out[module]["hosts"] = vuln_hosts
             if not out[module]:
                 del out[module]
         return out
@@ -134,32 +179,39 @@ class Report:
         :return: Dictionary containing the results of the scan.
         :rtype: dict
         """
-        out = {}
-        for hostname in results:
-            # the results are good, we need to remove the "Entry" key but preserve the rest with the CaseInsensitiveDict
-            if hostname not in out:
-                out[hostname] = {}
-            if "errors" in results[hostname]:
-                out[hostname]["errors"] = results[hostname]["errors"][hostname]
-            for module in results[hostname]:
-                raw_results = {}
-                if "raw" in results[hostname][module]:
-                    raw_results = results[hostname][module]["raw"].copy()
-                if "Entry" in results[hostname][module]:
-                    out[hostname][module] = CaseInsensitiveDict(
-                        results[hostname][module]["Entry"]
-                    )
-                    if raw_results:
-                        out[hostname][module]["raw"] = pformat(
-                            raw_results.copy(), indent=2
-                        )
-        return out
+        # each host is formatted independently from the others
+        return {hostname: _format_host(hostname, host_results) for hostname, host_results in results.items()}
+
+    def __environment(self) -> Environment:
+        """
+        Returns the jinja2 environment, building it on first use.
+
+        :return: The jinja2 environment shared by all the reports.
+        :rtype: Environment
+        """
+        if Report._env is None:
+            # the bytecode cache (in the system temp folder) avoids compiling the templates again on the next runs,
+            # it is optional: if the temp folder is not usable the report is generated without it
+            try:
+                bytecode_cache = FileSystemBytecodeCache()
+            except (OSError, RuntimeError) as e:
+                self.__logging.debug(f"Jinja2 bytecode cache disabled: {e}")
+                bytecode_cache = None
+            # the templates never change during a run, so they are compiled once and kept in memory
+            Report._env = Environment(
+                loader=FileSystemLoader(searchpath=self.__template_dir),
+                bytecode_cache=bytecode_cache,
+                auto_reload=False,
+                cache_size=-1,
+            )
+        return Report._env
 
-    def __jinja2__report(
-            self, mode: Mode, results: dict, modules: list, date: datetime.date, rml: bool = False
+    def __jinja2__stream(
+            self, mode: Mode, results: dict, modules: list, date: datetime, rml: bool = False
     ):
         """
-        Generates the report using jinja2.
+        Generates the report using jinja2, the rendered output is returned as a stream to be written in chunks
+        together with the formatted results, so that they can be reused by the other outputs.
 
         :param mode: Report mode.
         :type mode: Mode
@@ -168,27 +220,27 @@ class Report:
         :param modules: List of modules to include in the report.
         :type modules: list
         :param date: Date of the scan.
-        :type date: datetime.date
+        :type date: datetime
         :param rml: Whether to apply jinja2 to rml files or not.
         :type rml: bool
+        :return: Tuple containing the rendered report and the formatted results.
+        :rtype: tuple
         """
         self.__logging.debug(f"Generating report in jinja2..")
-        fsl = FileSystemLoader(searchpath=self.__template_dir)
-        env = Environment(loader=fsl)
         file_extension = "xml" if rml else "html"
         to_process = {"version": version, "date": date, "modules": modules, "hosts": list(results.keys())}
         if mode == self.Mode.MODULES:
             self.__logging.info(f"Generating modules report..")
-            template = env.get_template(f"modules_report.{file_extension}")
+            template = self.__environment().get_template(f"modules_report.{file_extension}")
             to_process["results"] = self.__modules_report_formatter(results, modules)
         elif mode == self.Mode.HOSTS:
             self.__logging.info(f"Generating hosts report..")
-            template = env.get_template(f"hosts_report.{file_extension}")
+            template = self.__environment().get_template(f"hosts_report.{file_extension}")
             to_process["results"] = self.__hosts_report_formatter(results)
         else:
             raise ValueError(f"Unknown mode: {mode}")
         to_process = {**to_process, **self._replacements}
-        return template.render(**to_process)
+        return template.stream(**to_process), to_process["results"]
 
     def __extract_results(self, res: dict) -> tuple:
         """
@@ -200,14 +252,16 @@ class Report:
         :rtype: tuple
         """
         # due to the fact that the results are in a dict with the loaded_modules, we have to extract the results
-        # by removing the loaded_modules
+        # by removing the loaded_modules, the input dictionary is left untouched
         modules = {}
-        for hostname in res:
-            if "loaded_modules" in res[hostname]:
-                modules.update(res[hostname]["loaded_modules"].copy())
-                del res[hostname]["loaded_modules"]
-                res[hostname] = res[hostname]["results"]
-        return res, modules
+        extracted = {}
+        for hostname, host_res in res.items():
+            if "loaded_modules" in host_res:
+                modules.update(host_res["loaded_modules"])
+                extracted[hostname] = host_res["results"]
+            else:
+                extracted[hostname] = host_res
+        return extracted, modules
 
     # sending results to the webhook with an exception safe way
     def __send_webhook(
@@ -307,79 +361,73 @@ class Report:
             ]
         )
 
-        if not Path("results").exists():
-            self.__logging.debug("Adding result folder...")
-            mkdir("results")
-        if not Path(f"results{sep}assets").exists():
+        self.__logging.debug("Adding result folder...")
+        makedirs(RESULTS_PATH, exist_ok=True)
+        # the assets are copied and not linked, so that the results folder can be moved (or mounted) elsewhere
+        if not ASSETS_SENTINEL.exists():
             self.__logging.debug("Copying assets folder...")
-            cp(
-                str(Path(f"configs{sep}out_template{sep}assets").absolute()),
-                str(Path(f"results{sep}assets").absolute()),
-            )
+            copytree(ASSETS_PATH, RESULTS_ASSETS_PATH, dirs_exist_ok=True)
+            ASSETS_SENTINEL.touch()
 
         output_file = Path(f"results{sep}{self.__path.stem}.html")
         output_path = output_file.absolute()
         results, modules = self.__extract_results(
             self.__input_dict["results"]
         )  # obtain results removing loaded_modules
-        results = pruner(results)  # prune empty results
         # get webserver types
         webserver_types = WebserverType().output()
         # this block is needed to prepare the output of the compliance modules
-        if any([module in modules for module in ["compare_one", "compare_many"]]):
-            module = "compare_one" if "compare_one" in modules else "compare_many"
-            for hostname in results:
-                if results[hostname].get(module):
-                    for sheet in results[hostname][module]:
-                        if "mitigation" in results[hostname][module][sheet]:
+        compare_modules = {"compare_one", "compare_many"} & modules.keys()
+        if compare_modules:
+            module = "compare_one" if "compare_one" in compare_modules else "compare_many"
+            for hostname, host_results in results.items():
+                compare_results = host_results.get(module)
+                if compare_results:
+                    sheets = {}
+                    for sheet, sheet_results in compare_results.items():
+                        if "mitigation" in sheet_results:
                             modules[module + "_" + sheet] = ""
-                            results[hostname][module + "_" + sheet] = results[hostname][module][sheet]
-                        elif "placeholder" in results[hostname][module][sheet]:
+                            sheets[module + "_" + sheet] = sheet_results
+                        elif "placeholder" in sheet_results:
                             modules[module + "_" + sheet] = ""
                         else:
                             self.__logging.debug(f"Removing {sheet} from {hostname} because no mitigation was found")
-                results[hostname].pop(module, None)
+                    # a new dict is built to leave the input results untouched
+                    results[hostname] = {
+                        **{k: v for k, v in host_results.items() if k != module},
+                        **sheets,
+                    }
             del modules[module]
-        # now, we want to divide raw from mitigations
-        for hostname in results:
+        # now, we want to prune empty results and divide raw from mitigations, in a single pass
+        # a top level mitigation wins, otherwise the first nested one found is used
+        results = prune_and_split(results)
+        for hostname, host_results in results.items():
             webserver_type = webserver_types.get(hostname, "").title()
-            for module in results[hostname]:
-                raw = results[hostname][module].copy()
-                if "mitigation" in raw:
-                    del raw["mitigation"]
-                for mitigation in rec_search_key(
-                        "mitigation", results[hostname][module]
-                ):
-                    if mitigation is not None:
-                        # remove the other mitigation types
-                        if webserver_type in mitigation.get("Entry", {}).get("Mitigation", {}):
-                            # Remove all the mitigations that don't apply to this configuration
-                            to_remove = [el for el in mitigation["Entry"]["Mitigation"] if
-                                         el not in ["Textual", webserver_type]]
-                            for element in to_remove:
-                                del mitigation["Entry"]["Mitigation"][element]
-                        results[hostname][
-                            module
-                        ] = (
-                            mitigation.copy()
-                        )  # i'm expecting only one mitigation per module, is it ok?
-                results[hostname][module]["raw"] = raw
+            for module_results in host_results.values():
+                # remove the other mitigation types
+                if webserver_type in module_results.get("Entry", {}).get("Mitigation", {}):
+                    # Remove all the mitigations that don't apply to this configuration
+                    to_remove = [el for el in module_results["Entry"]["Mitigation"] if
+                                 el not in ["Textual", webserver_type]]
+                    for element in to_remove:
+                        del module_results["Entry"]["Mitigation"][element]
         use_rml = False
         if self.__path.suffix.lower() == ".pdf":
             self.__logging.debug("Using jinja2 to generate RML...")
             use_rml = True
             output_path = f"{output_file.absolute().parent}{sep}{output_file.stem}.rml"
 
-        with open(output_path, "w") as f:
-            f.write(
-                self.__jinja2__report(
-                    mode=self.__input_dict["mode"],
-                    modules=list(modules.keys()),
-                    results=results,
-                    date=datetime.now().replace(microsecond=0),
-                    rml=use_rml
-                )
-            )
+        report_date = datetime.now().replace(microsecond=0)
+        rendered_stream, formatted_results = self.__jinja2__stream(
+            mode=self.__input_dict["mode"],
+            modules=list(modules.keys()),
+            results=results,
+            date=report_date,
+            rml=use_rml
+        )
+        # the report is written while it is rendered, so it is never held entirely in memory
+        with open(output_path, "w", buffering=1 << 20) as f:
+            rendered_stream.dump(f)
 
         self.__logging.debug("Checking if needs pdf...")
         if self.__path.suffix.lower() == ".pdf":
@@ -402,14 +450,10 @@ class Report:
             stix_output_path = Path(
                 f"{output_file.absolute().parent}{sep}stix_{output_file.stem}.json"
             ).absolute()
-            results_to_stix = (
-                self.__hosts_report_formatter(results)
-                if self.__input_dict["mode"] == self.Mode.HOSTS
-                else self.__modules_report_formatter(results, modules)
-            )
             self.__logging.info("Starting STIX generation...")
+            # the results have already been formatted for the report, no need to do it again
             Stix(type_of_analysis=self.__input_dict["mode"].value).build_and_save(
-                results_to_stix, modules, str(stix_output_path)
+                formatted_results, modules, str(stix_output_path)
             )
         self.__logging.debug("Checks if needs webhook...")
         if "webhook" in self.__input_dict and self.__input_dict["webhook"]:
@@ -0,0 +1,56 @@
+from utils.prune import pruner, prune_and_split
+
+
+def test_pruner():
+    data = {"a": "", "b": None, "c": {}, "d": {"e": ""}, "f": 1, "g": {"h": "x", "i": None}}
+    assert pruner(data) == {"f": 1, "g": {"h": "x"}}
+
+
+def test_prune_and_split_top_level_mitigation():
+    mitigation = {"Entry": {"Name": "BEAST", "Mitigation": {"Textual": "fix", "Apache": ""}}}
+    data = {"host": {"beast": {"finding": "vulnerable", "empty": "", "mitigation": mitigation}}}
+    out = prune_and_split(data)
+    assert out == {
+        "host": {
+            "beast": {
+                "Entry": {"Name": "BEAST", "Mitigation": {"Textual": "fix"}},
+                "raw": {"finding": "vulnerable"},
+            }
+        }
+    }
+    # the input is left untouched
+    assert "raw" not in mitigation
+    assert mitigation["Entry"]["Mitigation"]["Apache"] == ""
+
+
+def test_prune_and_split_nested_mitigation():
+    data = {
+        "app.apk": {
+            "sslerror": {
+                "sslerror": [{"empty": False, "mitigation": {"Entry": {"Name": "SSL_ERROR"}}}]
+            }
+        }
+    }
+    out = prune_and_split(data)
+    assert out["app.apk"]["sslerror"]["Entry"] == {"Name": "SSL_ERROR"}
+    assert out["app.apk"]["sslerror"]["raw"] == {"sslerror": [{"empty": False}]}
+
+
+def test_prune_and_split_without_mitigation():
+    data = {"host": {"errors": {"host": {"testssl": "timeout", "other": ""}}, "empty": {"a": None}}, "other": {}}
+    out = prune_and_split(data)
+    errors = {"host": {"testssl": "timeout"}}
+    assert out == {"host": {"errors": {**errors, "raw": errors}}}
+
+
+def test_prune_and_split_shared_mitigation():
+    # the same mitigation instance reported for two hosts must not share the raw results
+    mitigation = {"Entry": {"Name": "BEAST"}}
+    data = {
+        "host1": {"beast": {"finding": "a", "mitigation": mitigation}},
+        "host2": {"beast": {"finding": "b", "mitigation": mitigation}},
+    }
+    out = prune_and_split(data)
+    assert out["host1"]["beast"] is not out["host2"]["beast"]
+    assert out["host1"]["beast"]["raw"] == {"finding": "a"}
+    assert out["host2"]["beast"]["raw"] == {"finding": "b"}
@@ -13,3 +13,70 @@ def pruner(data):
         if not v in ("", None, {}):
             new_data[k] = v
     return new_data
+
+
+def prune_and_split(data):
+    """
+    Prune the results and separate the mitigation of each module from its raw results, visiting each node once.
+    :param data: The results to be pruned, in the form hostname -> module -> results.
+    :type data: dict
+    :return: The pruned results, each module is replaced by its mitigation (if any) with the raw results under the
+        "raw" key.
+    :rtype: dict
+    """
+    new_data = {}
+    for hostname, host_results in data.items():
+        if isinstance(host_results, dict):
+            new_host = {}
+            for module, module_results in host_results.items():
+                if isinstance(module_results, dict):
+                    mitigation, raw = _prune_and_split(module_results)
+                    if mitigation is not None:
+                        mitigation["raw"] = raw
+                        new_host[module] = mitigation
+                    elif raw:
+                        new_host[module] = {**raw, "raw": raw}
+                elif not module_results in ("", None, {}):
+                    new_host[module] = module_results
+            host_results = new_host
+        if not host_results in ("", None, {}):
+            new_data[hostname] = host_results
+    return new_data
+
+
+def _prune_and_split(data):
+    """
+    Recursive step of prune_and_split.
+    :param data: The data to be pruned.
+    :type data: dict or list
+    :return: Tuple containing the mitigation found (None if missing) and the pruned data without any mitigation.
+    :rtype: tuple
+    """
+    if isinstance(data, dict):
+        mitigation = None
+        nested_mitigation = None
+        raw = {}
+        for k, v in data.items():
+            if k == "mitigation":
+                if isinstance(v, dict):
+                    v = pruner(v)
+                if not v in ("", None, {}):
+                    mitigation = v
+                continue
+            nested, v = _prune_and_split(v)
+            if nested_mitigation is None:
+                nested_mitigation = nested
+            if not v in ("", None, {}):
+                raw[k] = v
+        # a top level mitigation has the precedence over the nested ones
+        return (mitigation if mitigation is not None else nested_mitigation), raw
+    if isinstance(data, list):
+        mitigation = None
+        raw = []
+        for v in data:
+            nested, v = _prune_and_split(v)
+            if mitigation is None:
+                mitigation = nested
+            raw.append(v)
+        return mitigation, raw
+    return None, data